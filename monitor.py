@@ -1,39 +1,105 @@
 import os
+import re
+import html
 import sys
+import atexit
+import threading
+import queue
+import sqlite3
+import multiprocessing
 import time
-import glob
+import random
+import functools
 import logging
-from logging.handlers import RotatingFileHandler
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from dotenv import load_dotenv
 
+import httpx
 import yt_dlp
-import google.generativeai as genai
+from google import genai
+from google.genai import errors as genai_errors
 from linebot import LineBotApi
 from linebot.models import TextSendMessage
 
 # ================= 1. 環境設定 =================
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 LOG_FILE = os.path.join(BASE_DIR, "service.log")
-HISTORY_FILE = os.path.join(BASE_DIR, "processed_videos.txt")
-
-# 載入 .env
-load_dotenv(os.path.join(BASE_DIR, ".env"))
-
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-LINE_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
-LINE_USER_ID = os.getenv("LINE_USER_ID")
-CHANNELS_STR = os.getenv("TARGET_CHANNELS", "")
-TARGET_CHANNELS = [url.strip() for url in CHANNELS_STR.split(",") if url.strip()]
-
-if not all([GOOGLE_API_KEY, LINE_TOKEN, LINE_USER_ID]):
-    print("❌ 錯誤：請檢查 .env 檔案，API Key 缺失！")
-    sys.exit(1)
-
-genai.configure(api_key=GOOGLE_API_KEY)
+HISTORY_FILE = os.path.join(BASE_DIR, "processed_videos.txt")  # 舊版紀錄，首次啟動時匯入 DB
+HISTORY_DB = os.path.join(BASE_DIR, "processed.db")
+FILE_PROCESSING_TIMEOUT = 600  # Gemini 處理音檔的最長等待秒數
+POLL_MIN_INTERVAL = 60    # 頻道巡邏間隔下限 (有新片時重置)
+POLL_MAX_INTERVAL = 1800  # 頻道巡邏間隔上限 (連續沒新片時 x1.5 遞增)
+ANALYZE_WORKERS = 2       # 分析子行程數 (同時上傳 / 分析的影片數)
+ANALYZER_JOB_LIMIT = 2    # 每個分析子行程最多排幾支影片
+ANALYZER_CHECK_INTERVAL = 10  # 檢查分析子行程是否存活的間隔秒數
+GEMINI_MODEL = "gemini-flash-latest"
+API_COOLDOWN_BASE = 60    # 重試用盡仍 429 時暫停分析的起始秒數 (連續受限 x2 遞增)
+API_COOLDOWN_MAX = 3600
+RETRY_BACKOFF_BASE = 60   # 單支影片分析失敗後的重試間隔起始秒數 (每次失敗 x2 遞增)
+RETRY_BACKOFF_MAX = 3600
+SUBTITLE_LANGS = ['zh-TW', 'zh-Hant', 'zh']  # 有字幕就用字幕分析，不必下載音檔
+
+@dataclass(frozen=True)
+class Config:
+    google_api_key: str
+    line_token: str
+    line_user_id: str
+    target_channels: tuple
+
+@functools.cache
+def get_config():
+    """載入 .env 並驗證，只做一次 (重複 import 也不會重跑)"""
+    load_dotenv(os.path.join(BASE_DIR, ".env"))
+    channels_str = os.getenv("TARGET_CHANNELS", "")
+    config = Config(
+        google_api_key=os.getenv("GOOGLE_API_KEY"),
+        line_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN"),
+        line_user_id=os.getenv("LINE_USER_ID"),
+        target_channels=tuple(url.strip() for url in channels_str.split(",") if url.strip()),
+    )
+    if not all([config.google_api_key, config.line_token, config.line_user_id]):
+        print("❌ 錯誤：請檢查 .env 檔案，API Key 缺失！")
+        sys.exit(1)
+    return config
+
+CONFIG = get_config()
+TARGET_CHANNELS = CONFIG.target_channels
+
+# 單一 Gemini client，所有上傳 / 輪詢 / 生成共用同一個 HTTP 連線池
+GENAI_CLIENT = genai.Client(api_key=CONFIG.google_api_key)
+
+# 共用連線：LINE API 與 yt-dlp 實例只建立一次，保留 HTTP 連線池
+LINE_API = LineBotApi(CONFIG.line_token)
+
+YDL_FLAT_OPTS = {'extract_flat': 'in_playlist', 'playlistend': 1, 'quiet': True, 'no_warnings': True, 'skip_download': True}
+YDL_DL_OPTS = {
+    # 語音分析不需要高音質：取 32 kbps 以上最小的純音軌。
+    # 排序先看 lang，多語 / 自動配音影片仍會選到原始語言的音軌
+    'format': 'bestaudio[abr>=32]/bestaudio',
+    'format_sort': ['lang', '+abr'],
+    'quiet': True,
+    'no_warnings': True,
+}
+YDL_DL = None  # 只有主行程的下載執行緒會用，由 init_parent() 建立
+
+# YoutubeDL 不是 thread-safe，巡邏執行緒各自持有一個
+_ydl_local = threading.local()
+
+def get_flat_ydl():
+    ydl = getattr(_ydl_local, "ydl", None)
+    if ydl is None:
+        ydl = _ydl_local.ydl = yt_dlp.YoutubeDL(YDL_FLAT_OPTS)
+        atexit.register(ydl.close)
+    return ydl
 
 # ================= 2. Log 系統 =================
 def setup_logger():
     logger = logging.getLogger("StockBot")
+    # 已經掛過 handler (例如被重複 import)，不要再掛一次，否則每筆 log 會寫兩次
+    if logger.handlers:
+        return logger
     logger.setLevel(logging.INFO)
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     file_handler = RotatingFileHandler(LOG_FILE, maxBytes=1_000_000, backupCount=5, encoding='utf-8')
@@ -44,98 +110,269 @@ def setup_logger():
     logger.addHandler(console_handler)
     return logger
 
-logger = setup_logger()
+# 只有主行程呼叫 setup_logger() 掛檔案 / console handler；
+# 分析子行程 (spawn 會重新 import 本模組) 由 analyze_process 掛 QueueHandler 送回主行程
+logger = logging.getLogger("StockBot")
 
 # ================= 3. 核心功能 =================
 
+# 連線逾時 / 中斷 (例如上傳大檔途中斷線) 也視為暫時性錯誤
+RETRYABLE_TRANSPORT_ERRORS = (httpx.TimeoutException, httpx.TransportError)
+
+def _is_retryable(e):
+    """視為「暫時性」的錯誤：額度用盡 (429) / 伺服器忙碌 (5xx) / 連線問題"""
+    if isinstance(e, RETRYABLE_TRANSPORT_ERRORS): return True
+    return isinstance(e, genai_errors.ServerError) or getattr(e, "code", None) == 429
+
+def _server_retry_delay(e):
+    """取出伺服器建議的等待秒數 (RetryInfo.retryDelay)，沒有則回傳 None"""
+    details = getattr(e, "details", None)
+    if not isinstance(details, dict): return None
+    for d in details.get("error", {}).get("details", []):
+        delay = d.get("retryDelay")
+        if delay:
+            return float(delay.rstrip("s"))
+    return None
+
+def retry(attempts=6, base=3.0, factor=1.5, jitter=(1, 5)):
+    """
+    API 重試裝飾器：指數退避 + 隨機抖動
+    wait = base * factor**n + random.uniform(*jitter)
+    若伺服器有給建議等待時間，優先採用。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for n in range(attempts):
+                try:
+                    return func(*args, **kwargs)
+                except (genai_errors.APIError, *RETRYABLE_TRANSPORT_ERRORS) as e:
+                    if not _is_retryable(e) or n == attempts - 1:
+                        raise
+                    wait = _server_retry_delay(e)
+                    if wait is None:
+                        wait = base * factor ** n + random.uniform(*jitter)
+                    logger.warning(f"⚠️ API 暫時失敗 ({type(e).__name__})，{wait:.1f} 秒後重試 ({n + 1}/{attempts - 1})")
+                    time.sleep(wait)
+        return wrapper
+    return decorator
+
+def rate_limit_delay(e):
+    """重試用盡後仍是 429 -> 回傳伺服器建議的冷卻秒數 (沒有則 0)；其他錯誤回傳 None"""
+    if isinstance(e, genai_errors.APIError) and e.code == 429:
+        return _server_retry_delay(e) or 0.0
+    return None
+
+@retry()
+def upload_file(path, mime_type, display_name):
+    return GENAI_CLIENT.files.upload(file=path, config={'mime_type': mime_type, 'display_name': display_name})
+
+@retry()
+def get_file(name):
+    return GENAI_CLIENT.files.get(name=name)
+
+@retry()
+def generate_content(contents, config=None):
+    return GENAI_CLIENT.models.generate_content(model=GEMINI_MODEL, contents=contents, config=config)
+
+def open_history_db():
+    conn = sqlite3.connect(HISTORY_DB, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    # WAL 下 NORMAL 只在 checkpoint 時 fsync，每支影片的 commit 不用各自等磁碟
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS processed(video_id TEXT PRIMARY KEY, ts INTEGER)')
+    # 舊版文字檔紀錄一次性匯入：單一交易寫入，成功後改名，下次啟動不再匯入
+    if os.path.exists(HISTORY_FILE):
+        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
+            video_ids = f.read().split()
+        now = int(time.time())
+        conn.execute('BEGIN')
+        try:
+            conn.executemany('INSERT OR IGNORE INTO processed VALUES (?, ?)', ((vid, now) for vid in video_ids))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        os.replace(HISTORY_FILE, HISTORY_FILE + ".migrated")
+    return conn
+
+HISTORY_CONN = None  # 由 init_parent() 開啟，分析子行程不碰 DB
+_history_lock = threading.Lock()
+
 def load_history():
-    if not os.path.exists(HISTORY_FILE): return set()
-    with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-        return set(line.strip() for line in f)
+    with _history_lock:
+        return {row[0] for row in HISTORY_CONN.execute('SELECT video_id FROM processed')}
+
+def is_processed(video_id):
+    with _history_lock:
+        return HISTORY_CONN.execute('SELECT 1 FROM processed WHERE video_id=?', (video_id,)).fetchone() is not None
+
+# 已處理清單常駐記憶體，只在啟動時讀 DB 一次 (init_parent())
+HISTORY = set()
 
 def save_history(video_id):
-    with open(HISTORY_FILE, "a", encoding="utf-8") as f:
-        f.write(f"{video_id}\n")
+    HISTORY.add(video_id)
+    with _history_lock:
+        HISTORY_CONN.execute('INSERT OR IGNORE INTO processed VALUES (?, ?)', (video_id, int(time.time())))
 
 def get_latest_video(channel_url):
     logger.info(f"🔎 巡邏頻道: {channel_url}")
-    ydl_opts = {'extract_flat': True, 'playlistend': 5, 'quiet': True, 'no_warnings': True}
+    ydl = get_flat_ydl()
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        # 只抓最新 1 筆；若第 1 筆是 UC 開頭的頻道 ID，才多抓 1 筆重試
+        for playlistend in (1, 2):
+            ydl.params['playlistend'] = playlistend
             info = ydl.extract_info(channel_url, download=False)
-            if 'entries' in info and info['entries']:
-                for entry in info['entries']:
-                    if not entry: continue
-                    v_id = entry.get('id')
-                    v_title = entry.get('title')
-                    # 排除 UC 開頭的頻道 ID
-                    if v_id and not v_id.startswith('UC') and v_title:
-                        return v_id, v_title, f"https://www.youtube.com/watch?v={v_id}"
+            entries = info.get('entries') or []
+            if len(entries) < playlistend: break
+            entry = entries[playlistend - 1]
+            if not entry: continue
+            v_id = entry.get('id')
+            v_title = entry.get('title')
+            # 排除 UC 開頭的頻道 ID
+            if v_id and not v_id.startswith('UC') and v_title:
+                return v_id, v_title, f"https://www.youtube.com/watch?v={v_id}"
+            if not (v_id and v_id.startswith('UC')): break
     except Exception as e:
         logger.error(f"❌ 讀取頻道失敗: {e}")
     return None, None, None
 
-def download_audio_if_not_exists(url, video_id):
+# 暫存音檔索引 video_id -> path：啟動時掃一次目錄 (init_parent())，之後只在記憶體更新
+CACHE_INDEX = {}
+
+def build_cache_index():
+    for e in os.scandir(BASE_DIR):
+        if e.name.startswith('temp_') and e.name.endswith(('.m4a', '.webm')) and e.is_file():
+            CACHE_INDEX[e.name[5:].rsplit('.', 1)[0]] = e.path
+
+def remove_cached_audio(video_id):
+    path = CACHE_INDEX.pop(video_id, None)
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def download_audio_if_not_exists(url, video_id, info=None):
     """
     智慧下載：
-    1. 檢查檔案是否存在 (用 video_id 當檔名)
+    1. 檢查檔案是否存在 (查 CACHE_INDEX，用 video_id 當 key)
     2. 若存在 -> 直接回傳路徑 (不下載)
-    3. 若不存在 -> 下載
+    3. 若不存在 -> 下載並登記到 CACHE_INDEX
+    info 為先前 extract_info(process=False) 的結果時直接沿用，不再重抓 metadata
     """
-    # 建立一個專屬的檔名，例如: C:/.../temp_QVlUUZMmJcQ.m4a
-    expected_filename = f"temp_{video_id}" 
-    expected_path_m4a = os.path.join(BASE_DIR, f"{expected_filename}.m4a")
-    expected_path_webm = os.path.join(BASE_DIR, f"{expected_filename}.webm")
-
     # 【關鍵檢查】如果檔案已經在了，就不要下載！
-    if os.path.exists(expected_path_m4a):
-        logger.info(f"📂 發現暫存檔 (跳過下載): {expected_path_m4a}")
-        return expected_path_m4a
-    if os.path.exists(expected_path_webm):
-        logger.info(f"📂 發現暫存檔 (跳過下載): {expected_path_webm}")
-        return expected_path_webm
+    if video_id in CACHE_INDEX:
+        logger.info(f"📂 發現暫存檔 (跳過下載): {CACHE_INDEX[video_id]}")
+        return CACHE_INDEX[video_id]
 
     # 如果沒有，才開始下載
     logger.info(f"📥 開始下載: {url}")
     
-    ydl_opts = {
-        'format': 'bestaudio[ext=m4a]/bestaudio', 
-        # 使用 ID 當作檔名，確保下次能找到
-        'outtmpl': os.path.join(BASE_DIR, f'{expected_filename}.%(ext)s'),
-        'quiet': True,
-        'no_warnings': True,
-    }
+    # 使用 ID 當作檔名，例如: C:/.../temp_QVlUUZMmJcQ.m4a，確保下次能找到
+    YDL_DL.params['outtmpl'] = {'default': os.path.join(BASE_DIR, f'temp_{video_id}.%(ext)s')}
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
+        if info is not None:
+            info = YDL_DL.process_ie_result(info, download=True)
+        else:
+            info = YDL_DL.extract_info(url, download=True)
         
-        # 再次檢查下載後的檔案
-        if os.path.exists(expected_path_m4a): return expected_path_m4a
-        if os.path.exists(expected_path_webm): return expected_path_webm
-        return None
+        # 由 yt-dlp 回報的實際檔案路徑登記索引
+        downloads = info.get('requested_downloads') or []
+        path = downloads[0].get('filepath') if downloads else None
+        if not path: return None
+        CACHE_INDEX[video_id] = path
+        return path
     except Exception as e:
         logger.error(f"❌ 下載失敗: {e}")
         return None
 
-def analyze_audio(audio_path, title):
-    logger.info(f"🧠 AI 分析中: {title}")
-    mime = "audio/webm" if audio_path.endswith(".webm") else "audio/mp4"
-    myfile = genai.upload_file(audio_path, mime_type=mime)
-    
-    while myfile.state.name == "PROCESSING":
-        time.sleep(2)
-        myfile = genai.get_file(myfile.name)
+def _find_vtt(tracks, allow_translated=True):
+    for track in tracks or []:
+        url = track.get('url')
+        if track.get('ext') != 'vtt' or not url: continue
+        if not allow_translated and 'tlang=' in url: continue
+        return url
+    return None
 
-    if myfile.state.name == "FAILED":
-        raise ValueError("Audio processing failed on Google Server")
+def find_subtitle_url(info):
+    """
+    優先人工字幕，其次自動字幕；只取 vtt 格式。
+    自動字幕只接受原始語音辨識 (*-orig / 網址沒有 tlang)，
+    機器翻譯的字幕可能是誤判語言後再翻譯，不如直接聽音檔。
+    """
+    subtitles = info.get('subtitles') or {}
+    for lang in SUBTITLE_LANGS:
+        url = _find_vtt(subtitles.get(lang))
+        if url: return url
+    auto = info.get('automatic_captions') or {}
+    for lang in SUBTITLE_LANGS:
+        url = _find_vtt(auto.get(f'{lang}-orig'), False) or _find_vtt(auto.get(lang), False)
+        if url: return url
+    return None
+
+def vtt_to_text(vtt):
+    """去掉 WEBVTT 標頭、時間軸與標籤，還原 HTML 跳脫字元 (&gt; &amp;)，並合併自動字幕的重複行"""
+    lines = []
+    for line in vtt.splitlines():
+        line = line.strip()
+        if not line or '-->' in line or line.startswith(('WEBVTT', 'Kind:', 'Language:', 'NOTE')):
+            continue
+        line = html.unescape(re.sub(r'<[^>]+>', '', line)).strip()
+        if line and (not lines or lines[-1] != line):
+            lines.append(line)
+    return "\n".join(lines)
+
+def fetch_transcript(url):
+    """
+    嘗試取得影片字幕 (一次 metadata 請求 + 一次字幕請求，只有幾十 KB)
+    回傳 (字幕文字, metadata)；沒有字幕時字幕為 None，metadata 留給下載音檔時沿用。
+    """
+    info = None
+    try:
+        info = YDL_DL.extract_info(url, download=False, process=False)
+        sub_url = find_subtitle_url(info)
+        if not sub_url: return None, info
+        transcript = vtt_to_text(YDL_DL.urlopen(sub_url).read().decode('utf-8'))
+        if transcript:
+            logger.info(f"📝 取得字幕 ({len(transcript)} 字)，跳過音檔下載")
+        return transcript or None, info
+    except Exception as e:
+        logger.warning(f"⚠️ 字幕讀取失敗，改用音檔: {e}")
+        return None, info
 
-    model = genai.GenerativeModel("gemini-flash-latest")
-    
-    # 手機版極簡 Prompt
-    promptVideo = f"""
+def delete_remote_file(remote):
+    """刪除 Gemini 上的音檔並清掉 remote["name"]"""
+    name, remote["name"] = remote["name"], None
+    if not name: return
+    try:
+        GENAI_CLIENT.files.delete(name=name)
+    except Exception as e:
+        logger.warning(f"⚠️ 遠端音檔刪除失敗: {e}")
+
+def get_or_upload_audio(audio_path, remote):
+    if remote["name"]:
+        try:
+            myfile = get_file(remote["name"])
+            if myfile.state.name != "FAILED":
+                logger.info(f"☁️ 沿用已上傳音檔: {remote['name']}")
+                return myfile
+            # 遠端處理失敗的檔案無法再用，先刪掉再重新上傳
+            delete_remote_file(remote)
+        except genai_errors.ClientError as e:
+            # 遠端檔案已過期 (48 小時) 或不存在：Files API 多半回 403，也可能是 404，一律重新上傳
+            logger.info(f"☁️ 已上傳音檔無法沿用 ({e.code})，重新上傳")
+            remote["name"] = None
+    mime = "audio/webm" if audio_path.endswith(".webm") else "audio/mp4"
+    myfile = upload_file(audio_path, mime_type=mime, display_name=os.path.basename(audio_path))
+    remote["name"] = myfile.name
+    return myfile
+
+# 手機版極簡 Prompt：固定的指示放 system instruction，每支影片只送標題
+PROMPT_SYSTEM = """
     你是一位講話精準、不廢話的台股操盤手。
-    請分析影片「{title}」，產出給手機用戶看的「極簡快報」。
+    使用者會給你一支影片與標題，請產出給手機用戶看的「極簡快報」。
 
     【排版嚴格要求】：
     1. 絕對禁止 Markdown (不要用 ** 或 ## 或表格)。
@@ -162,84 +399,299 @@ def analyze_audio(audio_path, title):
     🛡️ 操盤建議：
     (給散戶的一個指令，例如：拉回找買點、切勿追高)
     """
+
+PROMPT_VIDEO_TMPL = "請分析影片「{title}」，產出給手機用戶看的「極簡快報」。"
+
+def analyze_audio(audio_path, title, remote):
+    logger.info(f"🧠 AI 分析中: {title}")
+    myfile = get_or_upload_audio(audio_path, remote)
+    
+    # 指數退避輪詢：0.5, 0.85, 1.4 ... 最多 10 秒一次，總共最多等 10 分鐘
+    delay = 0.5
+    deadline = time.monotonic() + FILE_PROCESSING_TIMEOUT
+    while myfile.state.name == "PROCESSING":
+        if time.monotonic() > deadline:
+            # 這份上傳已不可信，清掉遠端檔案，下次重新上傳
+            delete_remote_file(remote)
+            raise TimeoutError(f"Audio processing timed out after {FILE_PROCESSING_TIMEOUT} seconds")
+        time.sleep(delay)
+        delay = min(delay * 1.7, 10.0)
+        myfile = get_file(myfile.name)
+
+    if myfile.state.name == "FAILED":
+        delete_remote_file(remote)
+        raise ValueError("Audio processing failed on Google Server")
+
+    text = generate_report([myfile, PROMPT_VIDEO_TMPL.format(title=title)])
     
-    result = model.generate_content([myfile, promptVideo])
+    # 分析成功 -> 清掉遠端檔案
+    delete_remote_file(remote)
+    return text
+
+def analyze_transcript(transcript, title):
+    logger.info(f"🧠 AI 分析中 (字幕): {title}")
+    return generate_report([f"影片逐字稿：\n{transcript}", PROMPT_VIDEO_TMPL.format(title=title)])
+
+def generate_report(contents):
+    result = generate_content(contents, config={'system_instruction': PROMPT_SYSTEM})
     return result.text
 
 def send_line(msg):
     try:
-        api = LineBotApi(LINE_TOKEN)
-        api.push_message(LINE_USER_ID, TextSendMessage(text=msg))
+        LINE_API.push_message(CONFIG.line_user_id, TextSendMessage(text=msg))
         logger.info("✅ LINE 通知發送成功")
     except Exception as e:
         logger.error(f"❌ LINE 發送失敗: {e}")
 
-# ================= 4. 主迴圈 (智慧版) =================
+# ================= 4. 處理流水線 =================
+# 下載 (YouTube) 與分析 (Gemini) 不共用資源，拆成兩段同時進行：
+# 主迴圈 -> DOWNLOAD_Q -> 下載執行緒 -> 各子行程 job queue -> 分析子行程 -> result_q -> 結果執行緒
+# 分析放在獨立的 Python 行程 (spawn)，SDK 序列化 / JSON 解析不和巡邏、下載搶 GIL；
+# 歷史紀錄與暫存檔索引仍只由主行程寫入。
+DOWNLOAD_Q = queue.Queue(maxsize=4)
+IN_FLIGHT = set()  # 已排入流水線、尚未完成的影片，避免重複排隊
+# 已上傳到 Gemini、尚未分析成功的音檔 vid -> 遠端檔名：重試時直接沿用，不再重讀、重傳
+# (只省下重試時的重傳；第一次分析仍要從磁碟讀檔上傳)
+# 由主行程保管，隨 job 傳給任一個分析子行程；子行程用 remote = {"name": ...}
+# 記錄這次用到的遠端檔，做完再隨結果回報給主行程。
+UPLOADED_FILES = {}
+FAILED_VIDEOS = {}  # 分析失敗的影片 vid -> (失敗次數, 下次可重試時間)
+API_COOLDOWN = {"until": 0.0, "strikes": 0}  # 額度持續受限時，整個分析階段暫停到 until
+
+def wait_for_api_cooldown():
+    remaining = API_COOLDOWN["until"] - time.monotonic()
+    if remaining > 0:
+        logger.info(f"⏳ API 冷卻中，分析暫停 {remaining:.0f} 秒...")
+        time.sleep(remaining)
+
+MP_CTX = multiprocessing.get_context("spawn")
+
+# 每個分析子行程：{"proc": Process, "q": 專屬 job queue, "jobs": 手上的 vid}
+# 各自一條 queue，子行程掛掉時才知道哪些影片跟著遺失
+ANALYZERS = []
+_analyzers_lock = threading.Lock()
+
+def start_analyzer(name, result_q, log_q):
+    job_q = MP_CTX.Queue()
+    proc = MP_CTX.Process(target=analyze_process, args=(job_q, result_q, log_q), name=name, daemon=True)
+    proc.start()
+    return {"proc": proc, "q": job_q, "jobs": set()}
+
+def dispatch_job(job):
+    """交給還活著、手上工作最少的分析子行程；全部滿載 (或都掛了等重啟) 就等"""
+    while True:
+        with _analyzers_lock:
+            alive = [w for w in ANALYZERS if w["proc"].is_alive()]
+            if alive:
+                w = min(alive, key=lambda w: len(w["jobs"]))
+                if len(w["jobs"]) < ANALYZER_JOB_LIMIT:
+                    w["jobs"].add(job[0])
+                    w["q"].put(job)
+                    return
+        time.sleep(1)
+
+def finish_job(vid):
+    with _analyzers_lock:
+        for w in ANALYZERS:
+            w["jobs"].discard(vid)
+
+def supervise_analyzers(result_q, log_q):
+    """定期檢查分析子行程：掛掉的重啟，它手上的影片移出 IN_FLIGHT，下次巡邏重新排隊"""
+    while True:
+        time.sleep(ANALYZER_CHECK_INTERVAL)
+        with _analyzers_lock:
+            for i, w in enumerate(ANALYZERS):
+                if w["proc"].is_alive(): continue
+                logger.error(f"💀 分析子行程 {w['proc'].name} 已結束 (exitcode={w['proc'].exitcode})，重新啟動")
+                for vid in w["jobs"]:
+                    IN_FLIGHT.discard(vid)
+                w["q"].cancel_join_thread()
+                w["q"].close()
+                ANALYZERS[i] = start_analyzer(w["proc"].name, result_q, log_q)
+
+def download_worker():
+    while True:
+        vid, title, url = DOWNLOAD_Q.get()
+        try:
+            wait_for_api_cooldown()
+
+            # 1. 有字幕就用字幕；已有暫存音檔則直接用音檔
+            transcript, info = (None, None) if vid in CACHE_INDEX else fetch_transcript(url)
+            if transcript:
+                dispatch_job((vid, title, url, None, transcript, None))
+                continue
+
+            # 2. 智慧下載 (檔案在就不載)
+            audio = download_audio_if_not_exists(url, vid, info)
+            if audio:
+                dispatch_job((vid, title, url, audio, None, UPLOADED_FILES.get(vid)))
+            else:
+                IN_FLIGHT.discard(vid)
+        except Exception as e:
+            logger.error(f"❌ 下載階段錯誤: {e}")
+            IN_FLIGHT.discard(vid)
+        finally:
+            DOWNLOAD_Q.task_done()
+
+def analyze_process(job_q, result_q, log_q):
+    """分析子行程：AI 分析 + 發 LINE，把成功與否回報給主行程"""
+    # 子行程的 log 全部送回主行程寫檔，避免兩個行程同時輪替同一個 log 檔
+    logger.setLevel(logging.INFO)
+    logger.addHandler(QueueHandler(log_q))
+
+    try:
+        while (job := job_q.get()) is not None:
+            vid, title, url, audio, transcript, remote_name = job
+            remote = {"name": remote_name}
+            ok = False
+            cooldown = None
+            try:
+                # 3. 嘗試 AI 分析
+                report = f"{url}\n\n"
+                if transcript:
+                    analysis = analyze_transcript(transcript, title)
+                else:
+                    analysis = analyze_audio(audio, title, remote)
+                report += analysis
+                send_line(report)
+                ok = True
+            except Exception as e:
+                # API 限制已在 retry() 內退避重試；走到這裡代表重試用盡或非 API 錯誤
+                logger.error(f"❌ 處理失敗: {e}")
+                cooldown = rate_limit_delay(e)
+            result_q.put((vid, title, ok, cooldown, remote["name"]))
+    except KeyboardInterrupt:
+        pass
+
+def result_worker(result_q):
+    while True:
+        vid, title, ok, cooldown, remote_name = result_q.get()
+        try:
+            # 記下遠端檔名，重試時不論分到哪個子行程都能沿用 (成功時子行程已刪掉遠端檔)
+            if remote_name and not ok:
+                UPLOADED_FILES[vid] = remote_name
+            else:
+                UPLOADED_FILES.pop(vid, None)
+
+            if ok:
+                # 4. 只有成功才存檔 + 刪檔
+                FAILED_VIDEOS.pop(vid, None)
+                API_COOLDOWN["strikes"] = 0
+                save_history(vid)
+                logger.info(f"✅ 任務成功: {title}")
+                
+                if vid in CACHE_INDEX:
+                    remove_cached_audio(vid)
+                    logger.info("🗑️ 暫存檔已清除")
+            else:
+                # 這裡我們先不存檔，讓它下次再試 (但因為有緩存檔案，不會重載)
+                # 同一支影片連續失敗時拉長重試間隔，避免每次巡邏都重打 API
+                failures = FAILED_VIDEOS.get(vid, (0, 0.0))[0] + 1
+                wait = min(RETRY_BACKOFF_BASE * 2 ** (failures - 1), RETRY_BACKOFF_MAX)
+                FAILED_VIDEOS[vid] = (failures, time.monotonic() + wait)
+                logger.info(f"⚠️ 保留檔案，{wait:.0f} 秒後再試 (第 {failures} 次失敗)")
+
+                # 重試用盡仍 429 (例如每日額度用完)：整個分析階段暫停
+                if cooldown is not None:
+                    API_COOLDOWN["strikes"] += 1
+                    pause = max(cooldown, min(API_COOLDOWN_BASE * 2 ** (API_COOLDOWN["strikes"] - 1), API_COOLDOWN_MAX))
+                    API_COOLDOWN["until"] = max(API_COOLDOWN["until"], time.monotonic() + pause)
+                    logger.warning(f"⚠️ API 額度持續受限，分析暫停 {pause:.0f} 秒")
+        except Exception as e:
+            logger.error(f"❌ 結果處理失敗: {e}")
+        finally:
+            finish_job(vid)
+            IN_FLIGHT.discard(vid)
+
+def init_parent():
+    """
+    只在主行程執行的初始化：歷史 DB、暫存檔索引、下載用 yt-dlp。
+    分析子行程 (spawn) 會重新 import 本模組，所以這些不能放在模組層級，
+    子行程只需要 Gemini client、LINE API 與 logger。
+    """
+    global HISTORY_CONN, YDL_DL
+    HISTORY_CONN = open_history_db()
+    atexit.register(HISTORY_CONN.close)
+    HISTORY.update(load_history())
+    build_cache_index()
+    YDL_DL = yt_dlp.YoutubeDL(YDL_DL_OPTS)
+    atexit.register(YDL_DL.close)
+
+# ================= 5. 主迴圈 (智慧版) =================
 if __name__ == "__main__":
+    setup_logger()
     logger.info("🤖 股票分析機器人已啟動 (Smart Flow)")
+    init_parent()
+
+    # 巡邏頻道用的執行緒池 (網路 I/O 為主，GIL 不是瓶頸)
+    poll_executor = ThreadPoolExecutor(max_workers=max(1, min(8, len(TARGET_CHANNELS))))
+
+    result_q = MP_CTX.Queue()
+    log_q = MP_CTX.Queue()
+
+    # 子行程送回來的 log 由主行程原本的 handler 寫出
+    log_listener = QueueListener(log_q, *logger.handlers)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+    # 多個分析子行程：不同影片的上傳 / 輪詢 / 生成可以重疊進行
+    with _analyzers_lock:
+        ANALYZERS.extend(start_analyzer(f"analyzer-{i}", result_q, log_q) for i in range(ANALYZE_WORKERS))
+
+    threading.Thread(target=supervise_analyzers, args=(result_q, log_q), name="supervisor", daemon=True).start()
+    threading.Thread(target=download_worker, name="downloader", daemon=True).start()
+    threading.Thread(target=result_worker, args=(result_q,), name="results", daemon=True).start()
     
-    # 預設等待時間
-    next_wait_time = 60 
+    # 每個頻道各自的巡邏間隔：沒新片就拉長，有新片就重置
+    poll_interval = {ch: POLL_MIN_INTERVAL for ch in TARGET_CHANNELS}
+    next_poll_at = {ch: 0.0 for ch in TARGET_CHANNELS}
+    last_seen = {}  # 每個頻道上次看到的最新影片，換了才算有新片
 
     while True:
         try:
-            history = load_history()
-            api_limit_hit = False # 標記是否撞到 API 牆
-            
-            for channel in TARGET_CHANNELS:
-                vid, title, url = get_latest_video(channel)
+            # 只巡邏到期的頻道，同時送出，誰先回來就先處理誰
+            now = time.monotonic()
+            due = [ch for ch in TARGET_CHANNELS if now >= next_poll_at[ch]]
+            futures = {poll_executor.submit(get_latest_video, ch): ch for ch in due}
+
+            for fut in as_completed(futures):
+                channel = futures[fut]
+                vid, title, url = fut.result()
+                # 只有最新影片換了才重置巡邏間隔；卡在重試的同一支影片不算
+                found_new = bool(vid) and vid != last_seen.get(channel)
+                if vid: last_seen[channel] = vid
                 
                 if vid:
-                    if vid in history:
+                    # 記憶體沒有時再查 DB (可能是另一個執行中的實例處理過)
+                    if vid in HISTORY or is_processed(vid):
+                        HISTORY.add(vid)
                         logger.info(f"😴 [跳過] 已分析: {title}")
+                    elif vid in IN_FLIGHT:
+                        logger.info(f"⏳ [處理中] 尚在流水線: {title}")
+                    elif time.monotonic() < FAILED_VIDEOS.get(vid, (0, 0.0))[1]:
+                        logger.info(f"⏳ [重試冷卻] 先前分析失敗，稍後再試: {title}")
+                    elif time.monotonic() < API_COOLDOWN["until"]:
+                        logger.info(f"⏳ [API 冷卻] 額度受限，稍後再處理: {title}")
                     else:
                         logger.info(f"⚡ [新片] 發現新影片: {title}")
-                        
-                        # 1. 智慧下載 (檔案在就不載)
-                        audio = download_audio_if_not_exists(url, vid)
-                        
-                        if audio:
-                            try:
-                                # 2. 嘗試 AI 分析
-                                report = f"{url}\n\n"
-                                analysis = analyze_audio(audio, title)
-                                report += analysis
-                                send_line(report)
-                                
-                                # 3. 只有成功才存檔 + 刪檔
-                                save_history(vid)
-                                logger.info(f"✅ 任務成功: {title}")
-                                
-                                if os.path.exists(audio):
-                                    os.remove(audio)
-                                    logger.info("🗑️ 暫存檔已清除")
-
-                            except Exception as e:
-                                err_msg = str(e)
-                                logger.error(f"❌ 處理失敗: {err_msg}")
-                                
-                                # 【關鍵修正】如果是 API 限制 (429/403)，啟動長睡眠
-                                if "429" in err_msg or "ResourceExhausted" in err_msg or "403" in err_msg:
-                                    logger.warning("⚠️ API 額度已滿或受限！將啟動 15 分鐘冷卻模式...")
-                                    api_limit_hit = True
-                                else:
-                                    # 其他錯誤 (如 AI 聽不懂)，可能要考慮跳過或重試
-                                    # 這裡我們先不存檔，讓它下次再試 (但因為有緩存檔案，不會重載)
-                                    logger.info("⚠️ 發生非 API 錯誤，保留檔案稍後重試。")
-
-                time.sleep(2)
+                        IN_FLIGHT.add(vid)
+                        DOWNLOAD_Q.put((vid, title, url))
+
+                if found_new:
+                    poll_interval[channel] = POLL_MIN_INTERVAL
+                else:
+                    poll_interval[channel] = min(poll_interval[channel] * 1.5, POLL_MAX_INTERVAL)
+                next_poll_at[channel] = time.monotonic() + poll_interval[channel]
             
-            # 根據是否撞牆決定休息多久
-            if api_limit_hit:
-                logger.info("⏳ 進入 API 冷卻模式: 休息 15 分鐘 (900秒)...")
-                time.sleep(900)
-            else:
-                logger.info("⏳ 待機 60 秒...")
-                time.sleep(60)
+            # 睡到下一個頻道到期為止
+            now = time.monotonic()
+            next_wait_time = max(1, min(next_poll_at.values(), default=now + POLL_MIN_INTERVAL) - now)
+            logger.info(f"⏳ 待機 {next_wait_time:.0f} 秒...")
+            time.sleep(next_wait_time)
 
         except KeyboardInterrupt:
             logger.warning("👋 程式手動停止")
             break
         except Exception as e:
             logger.critical(f"❌ 發生未預期錯誤: {e}")
-            time.sleep(60)
\ No newline at end of file
+            time.sleep(60)